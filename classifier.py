@@ -6,7 +6,7 @@ Copyright (c) 2025 by Thomas J. Daley. All rights reserved.
 See accompanying LICENSE file in repository root for details.
 
 - Recursively walks a root directory, skipping folders that start with "."
-- Converts each file to up to 5 PNG "pages" (PDF pages, images, or text rendered to image)
+- Converts each file to up to 5 JPEG "pages" (PDF pages, images, or text rendered to image)
 - Sends those images + a prompt (from file) to the chosen LLM
 - Prints "<provider> | <path> -> <classification>"
 
@@ -14,34 +14,50 @@ Configuration (via env or .env):
   LLM_NAME   : one of "openai", "anthropic", "gemini"
   LLM_API_KEY: API key for that provider
   PROMPT_FILE: path to a prompt text file
+  LLM_CONCURRENCY: max LLM requests in flight at once (default 32)
 
 Usage:
   $ pip install -r requirements.txt
   $ python classify_docs.py /path/to/root
 
 Notes:
-- For PDFs we use PyMuPDF (pure Python) to render images—no system deps.
-- For image files we normalize to PNG bytes.
-- For text-like files we render the first chunk of text onto a white PNG to preserve “layout” for the LLM.
-- Keep it simple: one request per file, first 5 pages/images max.
+- For PDFs we use pypdfium2 (bundled PDFium binaries) to render images—no system deps.
+- JPEG/PNG files under 5 MB are sent as-is; other image files are normalized to JPEG
+  bytes (PNG only if the image has transparency).
+- For text-like files we render the first chunk of text onto a white JPEG to preserve “layout” for the LLM.
+- Keep it simple: one request per file, first 5 pages/images max—except that
+  consecutive single-page files are batched up to --batch (default 4) per request.
+- Requests are dispatched concurrently (asyncio), bounded by LLM_CONCURRENCY.
+- Rendering runs in a process pool (one worker per CPU) and feeds the LLM callers
+  through a bounded queue, so rendering and network I/O overlap.
+- Labels are cached in ~/.cache/free_classifier.db keyed by file content, LLM, model
+  and prompt, so unchanged files are not re-sent on later runs (--no-cache to disable).
 """
 
 from __future__ import annotations
 
 import argparse
+import asyncio
 import base64
 import csv
+import hashlib
 import io
 import os
+import re
+import sqlite3
+import textwrap
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Awaitable, Callable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # Image/PDF helpers
 from PIL import Image, ImageDraw, ImageFont
-import fitz  # PyMuPDF
+import pypdfium2 as pdfium
 
 # Providers
 # Install: openai anthropic google-generativeai
@@ -49,9 +65,49 @@ import fitz  # PyMuPDF
 TEXT_EXTS = {".txt", ".md", ".eml", ".log", ".csv"}
 IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
 PDF_EXTS = {".pdf"}
+SUPPORTED_EXTS = TEXT_EXTS | IMAGE_EXTS | PDF_EXTS
 
 MAX_PAGES = 5
+PAGE_ENCODE_THREADS = 4  # per-PDF threads encoding pages while the next one renders
 TEXT_CHARS_LIMIT = 8000  # keep it short to fit onto one or two images if needed
+TEXT_MAX_BYTES = 50_000_000  # text files bigger than this are skipped (huge logs, dumps)
+
+# JPEG/PNG files whose base64 encoding fits in PASSTHROUGH_MAX_BYTES are sent
+# as-is (no decode + re-encode). The MIME type comes from the file's signature
+# and end marker, not its extension, so mis-named or truncated files take the
+# Pillow path instead.
+PASSTHROUGH_EXTS = {".jpg", ".jpeg", ".png"}
+PASSTHROUGH_SIGNATURES = [  # (leading bytes, trailing bytes, mime type)
+    (b"\xff\xd8\xff", b"\xff\xd9", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", b"IEND\xaeB`\x82", "image/png"),
+]
+PASSTHROUGH_MAX_BYTES = 5_000_000  # provider per-image limit, applied to the base64 data
+
+ImagePart = Tuple[bytes, str]  # (encoded image, mime type)
+RequestPart = Union[ImagePart, str]  # an image, or extra text (e.g. a batch separator)
+Classifier = Callable[[List[RequestPart]], Awaitable[str]]  # parts -> response text
+
+BATCH_INSTRUCTIONS = (
+    "This request contains {k} documents, not one, each introduced by a line like \"--- DOC 1 ---\". "
+    "Classify each document independently. Instead of a single label, return exactly "
+    "{k} labels, one per line, in document order. Write only the label on each line, "
+    "in the form asked for above: no numbering, no \"DOC n\" prefix, nothing else."
+)
+# Tolerated decorations on a batch reply line: bullets, "1.", "2)", "3 -", "DOC 4:", "--- DOC 5 ---".
+# A bare number only counts as numbering when whitespace (or the end) follows its
+# punctuation, so labels such as "1099-int" or "10-k" are left intact.
+BATCH_LINE_PREFIX = re.compile(r"^(?:[-*]\s*)?(?:(?:-+\s*)?doc(?:ument)?\s*#?\s*\d+\s*-*\s*[:.)-]?|#?\d+(?:[.):]|\s+-)(?:\s+|$))?\s*", re.IGNORECASE)
+
+CSV_FIELDS = ['filename', 'label', 'llm', 'model', 'path']
+CSV_FLUSH_EVERY = 20  # rows between flushes of the results CSV
+LOG_BATCH = 100  # status lines buffered between writes to the console/log file
+BATCH_WAIT_SECONDS = 0.5  # a partial --batch group is sent after this long without a new file
+
+CACHE_DB = Path.home() / ".cache" / "free_classifier.db"
+CACHE_COMMIT_EVERY = 100  # labels written per cache transaction (one fsync each)
+CACHE_TIMEOUT = 0.5  # seconds to wait for another run's lock on the cache DB
+
+HTTP_MAX_CONNECTIONS = 64  # keep-alive pool shared by all LLM calls in a run
 
 
 class AppSettings(BaseSettings):
@@ -59,6 +115,7 @@ class AppSettings(BaseSettings):
     llm_model: str = Field("default-model", alias="LLM_MODEL")
     llm_api_key: str = Field(..., alias="LLM_API_KEY")
     prompt_file: Path = Field(..., alias="PROMPT_FILE")
+    llm_concurrency: int = Field(32, alias="LLM_CONCURRENCY")
 
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8")
 
@@ -71,16 +128,28 @@ def read_prompt(prompt_path: Path) -> str:
     return prompt_path.read_text(encoding="utf-8").strip()
 
 
-def img_to_png_bytes(img: Image.Image) -> bytes:
+def has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+
+def encode_image(img: Image.Image) -> ImagePart:
+    """
+    Encode an image for upload. JPEG q75 is far smaller than PNG for document
+    pages; images with transparency fall back to (lightly compressed) PNG.
+    """
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    return buf.getvalue()
+    if has_alpha(img):
+        img.save(buf, format="PNG", compress_level=1, optimize=False)
+        return buf.getvalue(), "image/png"
+    img.save(buf, format="JPEG", quality=75, optimize=False)
+    return buf.getvalue(), "image/jpeg"
 
 
-def render_pdf_to_images(pdf_path: Path, max_pages: int = MAX_PAGES, zoom: float = 2.0) -> List[bytes]:
+def render_pdf_to_images(pdf_path: Path, max_pages: int = MAX_PAGES, zoom: float = 1.3) -> List[ImagePart]:
     """
-    Render first `max_pages` pages of a PDF to PNG bytes using PyMuPDF.
-    Zoom 2.0 ~ 144 DPI; adjust up/down if needed.
+    Render first `max_pages` pages of a PDF to JPEG bytes using PDFium.
+    Zoom 1.3 ~ 94 DPI, which is about what vision models downsample to anyway;
+    adjust up/down if needed.
 
     Args:
         pdf_path: Path to the PDF file.
@@ -88,31 +157,57 @@ def render_pdf_to_images(pdf_path: Path, max_pages: int = MAX_PAGES, zoom: float
         zoom: Zoom factor for rendering.
 
     Returns:
-        List of PNG byte strings, one per page.
+        List of (JPEG bytes, mime) tuples, one per page.
     """
-    images: List[bytes] = []
-    with fitz.open(pdf_path.as_posix()) as doc:
-        pages = min(len(doc), max_pages)
-        for i in range(pages):
-            page = doc.load_page(i)
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat, alpha=False)
-            images.append(pix.tobytes("png"))
-    return images
-
-
-def load_image_file(img_path: Path) -> List[bytes]:
+    pdf = pdfium.PdfDocument(pdf_path.as_posix())
+    bitmaps = []
+    try:
+        pages = min(len(pdf), max_pages)
+        if pages == 0:
+            return []
+        # RGB byte order lets Pillow wrap PDFium's buffer as-is (no BGR->RGB pass)
+        render_opts = {"scale": zoom, "rev_byteorder": True}
+        # PDFium is not thread-safe, so pages are rendered here, one at a time;
+        # the JPEG encodes (which release the GIL) run on a small thread pool
+        # and overlap with rendering the following pages.
+        with ThreadPoolExecutor(max_workers=min(pages, PAGE_ENCODE_THREADS)) as tp:
+            futures = []
+            for i in range(pages):
+                page = pdf[i]
+                bitmap = page.render(**render_opts)
+                page.close()
+                bitmaps.append(bitmap)  # to_pil() shares its buffer; keep it alive
+                futures.append(tp.submit(encode_image, bitmap.to_pil()))
+            return [f.result() for f in futures]
+    finally:
+        # free the native buffers now rather than at GC time
+        for bitmap in bitmaps:
+            bitmap.close()
+        pdf.close()
+
+
+def load_image_file(img_path: Path, ext: Optional[str] = None, size: Optional[int] = None) -> List[ImagePart]:
     """
-    Normalize any single image to PNG bytes (one page).
+    Return a single image as one page. JPEG/PNG files that fit in
+    PASSTHROUGH_MAX_BYTES once base64-encoded, and whose bytes really are a
+    complete JPEG/PNG, are forwarded untouched; anything else is normalized to
+    JPEG (or PNG if it has transparency).
     """
+    ext = ext if ext is not None else img_path.suffix.lower()
+    size = size if size is not None else img_path.stat().st_size
+    if ext in PASSTHROUGH_EXTS and 4 * ((size + 2) // 3) <= PASSTHROUGH_MAX_BYTES:  # base64 size
+        data = img_path.read_bytes()
+        for head, tail, mime in PASSTHROUGH_SIGNATURES:
+            if data.startswith(head) and data.endswith(tail):
+                return [(data, mime)]
     with Image.open(img_path) as im:
-        im = im.convert("RGB")
-        return [img_to_png_bytes(im)]
+        im = im.convert("RGBA" if has_alpha(im) else "RGB")
+        return [encode_image(im)]
 
 
-def wrap_text_to_image(text: str, width_px: int = 1600, height_px: int = 2000, margin: int = 40, line_spacing: int = 6) -> bytes:
+def wrap_text_to_image(text: str, width_px: int = 1600, height_px: int = 2000, margin: int = 40, line_spacing: int = 6) -> ImagePart:
     """
-    Draw text onto a white PNG. Uses a default Pillow font for simplicity.
+    Draw text onto a white JPEG. Uses a default Pillow font for simplicity.
 
     Args:
         text: The text to render.
@@ -122,196 +217,642 @@ def wrap_text_to_image(text: str, width_px: int = 1600, height_px: int = 2000, m
         line_spacing: Extra spacing between lines in pixels.
 
     Returns:
-        PNG byte string of the rendered text image.
+        (JPEG bytes, mime) of the rendered text image.
     """
-    # Basic wrapping—greedy by words
     font = ImageFont.load_default()
     draw_img = Image.new("RGB", (width_px, height_px), "white")
     draw = ImageDraw.Draw(draw_img)
 
-    max_text_width = width_px - 2 * margin
-    words = text.split()
-    lines = []
-    cur = ""
-    for w in words:
-        test = (cur + " " + w).strip()
-        if draw.textlength(test, font=font) <= max_text_width:
-            cur = test
-        else:
-            lines.append(cur)
-            cur = w
-    if cur:
-        lines.append(cur)
+    # Wrap by character count instead of measuring each line: size lines for the
+    # widest glyph in the text so nothing overflows, at the cost of a ragged right edge.
+    text = " ".join(text.split())
+    glyph_w = max((font.getlength(c) for c in set(text)), default=0) or font.getlength("M")
+    chars_per_line = max(1, int((width_px - 2 * margin) / glyph_w))
+    lines = textwrap.wrap(text, width=chars_per_line, break_long_words=True)
 
+    top, bottom = font.getbbox("Ay")[1::2]
+    line_h = bottom - top + line_spacing
     y = margin
     for line in lines:
         draw.text((margin, y), line, fill="black", font=font)
-        y += font.getbbox(line)[3] - font.getbbox(line)[1] + line_spacing
+        y += line_h
         if y > height_px - margin:
             break
 
-    return img_to_png_bytes(draw_img)
+    return encode_image(draw_img)
 
 
-def load_text_as_images(path: Path) -> List[bytes]:
+def load_text_as_images(path: Path) -> List[ImagePart]:
     """
     Read the first N chars and render as a single image.
     (We keep it to one image for simplicity.)
     """
-    text = path.read_text(errors="ignore", encoding="utf-8")[:TEXT_CHARS_LIMIT]
+    # Read only the head of the file: at most 4 bytes per UTF-8 character.
+    with open(path, "rb") as f:
+        raw = f.read(TEXT_CHARS_LIMIT * 4)
+    text = raw.decode("utf-8", errors="ignore")[:TEXT_CHARS_LIMIT]
     return [wrap_text_to_image(text)]
 
 
-def file_to_images(path: Path) -> Optional[List[bytes]]:
+def is_renderable(ext: str, size: int) -> bool:
     """
-    Convert a file to up to 5 PNG images (bytes) depending on type.
-    Returns None if the file type is unsupported.
+    Cheap pre-filter on the (lowercased) extension and size in bytes: False for
+    unsupported types, empty files and text files over TEXT_MAX_BYTES.
     """
-    ext = path.suffix.lower()
-    try:
-        if ext in PDF_EXTS:
-            return render_pdf_to_images(path, MAX_PAGES)
-        elif ext in IMAGE_EXTS:
-            return load_image_file(path)
-        elif ext in TEXT_EXTS:
-            return load_text_as_images(path)
-        else:
-            # Unknown—try best effort: if it's tiny binary or unknown, skip.
-            return None
-    except Exception as e:
-        print(f"[warn] Skipping {path}: {e}")
+    if ext not in SUPPORTED_EXTS or size == 0:
+        return False
+    return not (ext in TEXT_EXTS and size > TEXT_MAX_BYTES)
+
+
+def file_to_images(path: Path, ext: Optional[str] = None, size: Optional[int] = None) -> Optional[List[ImagePart]]:
+    """
+    Convert a file to up to MAX_PAGES (image bytes, mime) pages depending on type.
+    This is the only place the page limit is applied; providers send what they get.
+    Returns None if the file type is unsupported, the file is empty, or it is
+    a text file over TEXT_MAX_BYTES; these are rejected before the file is opened.
+    `ext` (lowercased suffix) and `size` (bytes) may be passed in if the caller
+    already has them. Unreadable or corrupt files raise; the caller reports them.
+    """
+    if ext is None:
+        ext = path.suffix.lower()
+    if ext not in SUPPORTED_EXTS:
         return None
+    if size is None:
+        size = path.stat().st_size
+    if not is_renderable(ext, size):
+        return None
+
+    if ext in PDF_EXTS:
+        return render_pdf_to_images(path, MAX_PAGES)
+    elif ext in IMAGE_EXTS:
+        return load_image_file(path, ext, size)
+    else:
+        return load_text_as_images(path)
+
+
+def init_render_worker() -> None:
+    """
+    Process-pool initializer: load the Pillow codec plugins (and, by importing this
+    module, PDFium) up front so the first file a worker renders doesn't pay for it.
+    """
+    Image.init()
 
 
 # =========== LLM CALLS ===========
 
-def to_b64_images(png_bytes_list: List[bytes]) -> List[str]:
-    return [base64.b64encode(b).decode("utf-8") for b in png_bytes_list[:MAX_PAGES]]
+# Invariant request pieces, built once and shared by every call
+OPENAI_SYSTEM_MSG = {"role": "system", "content": "You are a careful document classifier. Respond with a short, lowercase label like: bank_statement, credit_card_statement, email, text_message, social_media_message, or other. If you are given several documents, respond with one such label per line, in document order."}
+ANTHROPIC_SYSTEM = "You classify documents. Output a short, lowercase label only (one per line, in order, if you are given several documents)."
+
+
+def _http_client():
+    """
+    One pooled HTTP/2 client per provider, so calls reuse TCP/TLS connections
+    (and multiplex over them) instead of handshaking for every file.
+    """
+    import httpx
+    limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+    return httpx.AsyncClient(limits=limits, http2=True)
+
+
+def _openai_client(api_key: str):
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=api_key, http_client=_http_client())
+
+
+def _anthropic_client(api_key: str):
+    import anthropic
+    return anthropic.AsyncAnthropic(api_key=api_key, http_client=_http_client())
+
+
+def _gemini_model(api_key: str, model: str):
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model)
 
 
-def classify_with_openai(api_key: str, prompt: str, pngs: List[bytes], model: str = "gpt-4o-mini") -> str:
+async def classify_with_openai(client, prompt_part: dict, images: List[RequestPart], model: str = "gpt-4o-mini") -> str:
     """
     Minimal OpenAI image+text call using Chat Completions (gpt-4o-mini).
 
     Args:
-        api_key: OpenAI API key.
-        prompt: Text prompt to send.
-        pngs: List of PNG byte strings.
+        client: AsyncOpenAI client (see `_openai_client`).
+        prompt_part: Pre-built text content part holding the prompt.
+        images: List of (image bytes, mime) tuples; plain strings are sent as text parts.
     Returns:
         Classification label as a string.
     """
-    from openai import OpenAI
-    client = OpenAI(api_key=api_key)
-
-    b64s = to_b64_images(pngs)
-    content = [{"type": "text", "text": prompt}]
-    for b64 in b64s:
+    content = [prompt_part]
+    for item in images:
+        if isinstance(item, str):
+            content.append({"type": "text", "text": item})
+            continue
+        b, mime = item
+        # stay in bytes until the URL is complete; decode once
+        url = b"data:" + mime.encode("ascii") + b";base64," + base64.b64encode(b)
         content.append({
             "type": "image_url",
-            "image_url": {"url": f"data:image/png;base64,{b64}"}
+            "image_url": {"url": url.decode("ascii")}
         })
 
-    resp = client.chat.completions.create(
+    resp = await client.chat.completions.create(
         model=model,
-        messages=[
-            {"role": "system", "content": "You are a careful document classifier. Respond with a short, lowercase label like: bank_statement, credit_card_statement, email, text_message, social_media_message, or other."},
-            {"role": "user", "content": content}
-        ],
+        messages=[OPENAI_SYSTEM_MSG, {"role": "user", "content": content}],
         temperature=0
     )
     return (resp.choices[0].message.content or "").strip()
 
 
-def classify_with_anthropic(api_key: str, prompt: str, pngs: List[bytes], model: str = "claude-3-5-sonnet-latest") -> str:
+async def classify_with_anthropic(client, prompt_part: dict, images: List[RequestPart], model: str = "claude-3-5-sonnet-latest") -> str:
     """
     Minimal Anthropic Claude 3.5 Sonnet image+text call.
 
     Args:
-        api_key: Anthropic API key.
-        prompt: Text prompt to send.
-        pngs: List of PNG byte strings.
+        client: AsyncAnthropic client (see `_anthropic_client`).
+        prompt_part: Pre-built text content block holding the prompt.
+        images: List of (image bytes, mime) tuples; plain strings are sent as text parts.
     Returns:
         Classification label as a string.
     """
-    import anthropic
-    client = anthropic.Anthropic(api_key=api_key)
-
-    parts = [{"type": "text", "text": prompt}]
-    for b in pngs[:MAX_PAGES]:
+    parts = [prompt_part]
+    for item in images:
+        if isinstance(item, str):
+            parts.append({"type": "text", "text": item})
+            continue
+        b, mime = item
         parts.append({
             "type": "image",
             "source": {
                 "type": "base64",
-                "media_type": "image/png",
-                "data": base64.b64encode(b).decode("utf-8"),
+                "media_type": mime,
+                "data": base64.b64encode(b).decode("ascii"),
             },
         })
 
-    resp = client.messages.create(
+    resp = await client.messages.create(
         model=model,
         max_tokens=200,
         temperature=0,
-        system="You classify documents. Output a short, lowercase label only.",
+        system=ANTHROPIC_SYSTEM,
         messages=[{"role": "user", "content": parts}],
     )
     return (resp.content[0].text if resp.content else "").strip()
 
 
-def classify_with_gemini(api_key: str, prompt: str, pngs: List[bytes], model: str = "gemini-1.5-flash") -> str:
+async def classify_with_gemini(gm, prompt: str, images: List[RequestPart]) -> str:
     """
     Minimal Google Gemini (1.5 Flash) image+text call.
 
     Args:
-        api_key: Google Generative AI API key.
+        gm: GenerativeModel bound to the selected model (see `_gemini_model`).
         prompt: Text prompt to send.
-        pngs: List of PNG byte strings.
+        images: List of (image bytes, mime) tuples; plain strings are sent as text parts.
     Returns:
         Classification label as a string.
     """
-    import google.generativeai as genai
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model)
-
     # Build a list of parts: prompt text + image blobs
     parts = [prompt]
-    for b in pngs[:MAX_PAGES]:
-        parts.append({"mime_type": "image/png", "data": b})
+    for item in images:
+        if isinstance(item, str):
+            parts.append(item)
+        else:
+            b, mime = item
+            parts.append({"mime_type": mime, "data": b})
 
-    resp = model.generate_content(parts)
+    # The genai client is synchronous; run it off the event loop.
+    resp = await asyncio.to_thread(gm.generate_content, parts)
     return (getattr(resp, "text", "") or "").strip()
 
 
-def classify_images(llm_name: str, api_key: str, prompt: str, pngs: List[bytes], model: str) -> str:
+async def _no_close() -> None:
+    return None
+
+
+def make_classifier(llm_name: str, api_key: str, model: str, prompt: str) -> Tuple[Classifier, Callable[[], Awaitable[None]]]:
+    """
+    Build the classify call for the selected provider once per run: import only
+    that provider's SDK, construct its client, pre-build the prompt part, and
+    bind the static arguments. The hot path is then just `await classifier(images)`.
+
+    Returns:
+        (classifier, aclose): await `aclose()` at the end of the run to close the
+        client's connection pool.
+    """
     name = llm_name.strip().lower()
     if name == "openai":
-        return classify_with_openai(api_key, prompt, pngs, model)
+        client = _openai_client(api_key)
+        return partial(classify_with_openai, client, {"type": "text", "text": prompt}, model=model), client.close
     if name == "anthropic":
-        return classify_with_anthropic(api_key, prompt, pngs, model)
+        client = _anthropic_client(api_key)
+        return partial(classify_with_anthropic, client, {"type": "text", "text": prompt}, model=model), client.close
     if name == "gemini":
-        return classify_with_gemini(api_key, prompt, pngs, model)
+        return partial(classify_with_gemini, _gemini_model(api_key, model), prompt), _no_close
     raise ValueError(f"Unsupported LLM_NAME: {llm_name}")
 
 
 # =========== WALK + RUN ===========
 
-def iter_files(root: Path):
+class FileEntry(NamedTuple):
+    path: Path
+    ext: str  # lowercased suffix, e.g. ".pdf"
+    size: int  # bytes
+
+
+def iter_files(root: Path) -> Iterator[FileEntry]:
+    """
+    Yield all files under root, skipping files and directories that start with '.'.
+
+    Uses os.scandir with an explicit stack so the file-type checks come from the
+    directory listing, and the size from DirEntry.stat() (cached by the listing
+    on Windows). Like os.walk, symlinked directories are not followed and
+    unreadable directories are skipped.
+    """
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            stack.append(entry.path)
+                        continue
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                yield FileEntry(Path(entry.path), os.path.splitext(name)[1].lower(), size)
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    """
+    BLAKE2b (128-bit) hex digest of a file's contents, read in chunks.
     """
-    Yield all files under root, skipping directories that start with '.'.
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class LabelCache:
+    """
+    On-disk (SQLite) cache of labels keyed by (llm, model, prompt hash, file hash).
+
+    Writes are committed every `commit_every` labels and on close(), not one
+    transaction per label, since each commit is a blocking fsync on the event loop.
     """
-    for dirpath, dirnames, filenames in os.walk(root):
-        # mutate dirnames in-place to skip dot-directories
-        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
-        for fn in filenames:
-            # skip dot-files too
-            if fn.startswith("."):
+
+    def __init__(self, db_path: Path, llm_name: str, model: str, prompt: str, commit_every: int = CACHE_COMMIT_EVERY):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=CACHE_TIMEOUT)
+        self.commit_every = commit_every
+        self._pending = 0
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS labels ("
+            " llm TEXT, model TEXT, prompt_hash TEXT, file_hash TEXT, label TEXT,"
+            " PRIMARY KEY (llm, model, prompt_hash, file_hash))"
+        )
+        prompt_hash = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+        self.prefix = (llm_name.strip().lower(), model, prompt_hash)
+
+    def get(self, file_hash: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT label FROM labels WHERE llm = ? AND model = ? AND prompt_hash = ? AND file_hash = ?",
+            (*self.prefix, file_hash),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, file_hash: str, label: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO labels (llm, model, prompt_hash, file_hash, label) VALUES (?, ?, ?, ?, ?)",
+            (*self.prefix, file_hash, label),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self) -> None:
+        # On failure (e.g. another run holds the lock) the rows stay in the open
+        # transaction and go out with the next commit.
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self) -> None:
+        try:
+            if self._pending:
+                self.commit()
+        finally:
+            self.conn.close()
+
+
+def read_done_paths(output_csv: Path) -> set:
+    """
+    Return the set of paths already recorded in an existing results CSV (for --resume).
+    """
+    if not output_csv.exists():
+        return set()
+    with open(output_csv, newline='', encoding='utf-8') as csvfile:
+        return {row['path'] for row in csv.DictReader(csvfile) if row.get('path')}
+
+
+class RunLog:
+    """
+    Per-file status lines ([skip], [warn], [error], [dry]) collected in a ring
+    buffer and flushed every `batch` lines (and on close) as one block: a single
+    tqdm.write, so the progress bar redraws once per batch instead of per line,
+    plus an append to `log_path`.
+    """
+
+    def __init__(self, log_path: Path, append: bool = False, batch: int = LOG_BATCH):
+        from tqdm import tqdm
+        self._write = tqdm.write
+        self._buf: deque = deque(maxlen=batch)
+        self._file = open(log_path, 'a' if append else 'w', encoding='utf-8')
+
+    def __call__(self, msg: str) -> None:
+        self._buf.append(msg)
+        if len(self._buf) == self._buf.maxlen:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buf:
+            return
+        block = "\n".join(self._buf)
+        self._buf.clear()
+        self._write(block)
+        self._file.write(block + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+
+def result_row(path: Path, label: str, settings: AppSettings) -> dict:
+    # keep output very simple / greppable
+    return {'path': path.resolve(), 'label': label, 'llm': settings.llm_name, 'model': settings.llm_model, 'filename': path.name}
+
+
+async def render_worker(
+    files: Iterator[FileEntry],
+    render_q: asyncio.Queue,
+    done_q: asyncio.Queue,
+    pool: Executor,
+    settings: AppSettings,
+    cache: Optional[LabelCache] = None,
+    dry_run: bool = False,
+    log: Callable[[str], None] = print,
+) -> None:
+    """
+    Producer: pull files from the shared `files` iterator, render each one in the
+    process pool and put `(entry, file_hash, imgs)` on `render_q` for the LLM workers.
+
+    Files that finish here (cache hit, skipped, dry run, error) put their result
+    row (or None) straight on `done_q`.
+
+    Args:
+        files: Shared iterator of files to process.
+        render_q: Bounded queue of rendered files waiting for an LLM worker.
+        done_q: Queue of finished result rows (None for skipped/failed files).
+        pool: Executor that runs `file_to_images`.
+        settings: Application settings.
+        cache: Label cache; on a hit the file is neither rendered nor sent.
+        dry_run: If True, render only; do not call the LLM.
+        log: Sink for per-file status lines.
+    """
+    loop = asyncio.get_running_loop()
+    for entry in files:
+        path = entry.path
+        if not is_renderable(entry.ext, entry.size):
+            # Reject before hashing or rendering—never open these files at all
+            log(f"[skip] {path}")
+            await done_q.put(None)
+            continue
+        try:
+            file_hash = None
+            if cache is not None and not dry_run:
+                try:
+                    file_hash = await asyncio.to_thread(file_digest, path)
+                    label = cache.get(file_hash)
+                except (OSError, sqlite3.Error) as e:
+                    log(f"[warn] Not caching {path}: {e}")
+                    file_hash = None
+                else:
+                    if label is not None:
+                        await done_q.put(result_row(path, label, settings))
+                        continue
+
+            try:
+                imgs = await loop.run_in_executor(pool, file_to_images, path, entry.ext, entry.size)
+            except Exception as e:
+                log(f"[warn] Skipping {path}: {e}")
+                await done_q.put(None)
+                continue
+            if not imgs:
+                # Not a supported type—just note and continue
+                log(f"[skip] {path}")
+                await done_q.put(None)
+                continue
+
+            if dry_run:
+                log(f"[dry] {path} -> {len(imgs)} page(s)")
+                await done_q.put(None)
+                continue
+        except Exception as e:
+            log(f"[error] {path}: {e}")
+            await done_q.put(None)
+            continue
+
+        await render_q.put((entry, file_hash, imgs))
+
+
+def strip_numbering(line: str) -> str:
+    """
+    Drop any list numbering or "DOC n:" prefix from one line of a batch reply.
+    The label itself is left as the model wrote it.
+
+    >>> strip_numbering("2) Credit Card")
+    'Credit Card'
+    >>> strip_numbering("1099-int"), strip_numbering("10-k")
+    ('1099-int', '10-k')
+    """
+    return BATCH_LINE_PREFIX.sub("", line.strip()).strip()
+
+
+async def classify_batch(classifier: Classifier, pages: List[ImagePart]) -> Optional[List[str]]:
+    """
+    Classify several single-page documents in one request.
+
+    Returns one label per page, in order, or None if the response doesn't have
+    exactly one non-empty line per document (after stripping any numbering or
+    "DOC n:" prefixes).
+    """
+    parts: List[RequestPart] = [BATCH_INSTRUCTIONS.format(k=len(pages))]
+    for i, page in enumerate(pages, 1):
+        parts.append(f"--- DOC {i} ---")
+        parts.append(page)
+    resp = await classifier(parts)
+    labels = []
+    for line in resp.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        label = strip_numbering(line)
+        if not label:
+            return None
+        labels.append(label)
+    return labels if len(labels) == len(pages) else None
+
+
+async def batch_worker(
+    render_q: asyncio.Queue,
+    work_q: asyncio.Queue,
+    n_classifiers: int,
+    batch: int = 1,
+    wait: float = BATCH_WAIT_SECONDS,
+) -> None:
+    """
+    Sits between the renderers and the LLM workers and is the one place batches
+    are built: consecutive single-page files are grouped into lists of up to
+    `batch` items; multi-page files go through as lists of one. A partial batch is
+    flushed as soon as no new file arrives within `wait` seconds, so results keep
+    streaming to the CSV (and cache) while the run is in progress.
+
+    On the None sentinel from `render_q`, flushes what's left and sends one None
+    per LLM worker on `work_q`.
+    """
+    pending = []
+    while True:
+        if pending:
+            try:
+                item = await asyncio.wait_for(render_q.get(), wait)
+            except asyncio.TimeoutError:
+                await work_q.put(pending)
+                pending = []
                 continue
-            yield Path(dirpath) / fn
+        else:
+            item = await render_q.get()
+        if item is None:
+            break
+        if batch > 1 and len(item[2]) == 1:
+            pending.append(item)
+            if len(pending) >= batch:
+                await work_q.put(pending)
+                pending = []
+        else:
+            await work_q.put([item])
+    if pending:
+        await work_q.put(pending)
+    for _ in range(n_classifiers):
+        await work_q.put(None)
+
+
+async def classify_worker(
+    work_q: asyncio.Queue,
+    done_q: asyncio.Queue,
+    classifier: Classifier,
+    settings: AppSettings,
+    cache: Optional[LabelCache] = None,
+    log: Callable[[str], None] = print,
+) -> None:
+    """
+    Consumer: take work off `work_q` (a list of one file, or a batch of
+    single-page files from `batch_worker`) and classify it until a None sentinel
+    arrives. Each file's result row (or None on error) goes to `done_q`.
 
+    Batches whose reply can't be matched up are retried one file per request.
+    Only non-empty, single-line labels are cached; anything else is still
+    written to the CSV, so a later run asks again.
+    """
+    async def finish(item, label: Optional[str]) -> None:
+        # Every file must produce exactly one done_q entry, or main() waits forever.
+        entry, file_hash, _ = item
+        row = None
+        try:
+            if label is not None:
+                label = label.strip()
+                row = result_row(entry.path, label, settings)
+                if not label or "\n" in label:
+                    log(f"[warn] Unexpected reply for {entry.path}, not caching it: {label[:80]!r}")
+                elif file_hash is not None:
+                    try:
+                        cache.put(file_hash, label)
+                    except sqlite3.Error as e:
+                        log(f"[warn] Not caching {entry.path}: {e}")
+        except Exception as e:
+            log(f"[error] {entry.path}: {e}")
+        finally:
+            await done_q.put(row)
+
+    async def run_single(item) -> None:
+        label = None
+        try:
+            label = await classifier(item[2])
+        except Exception as e:
+            log(f"[error] {item[0].path}: {e}")
+        finally:
+            await finish(item, label)
 
-def main():
+    async def run_batch(items) -> None:
+        try:
+            labels = await classify_batch(classifier, [imgs[0] for _, _, imgs in items])
+        except Exception as e:
+            log(f"[warn] Batch of {len(items)} failed ({e}); retrying one at a time")
+            labels = None
+        else:
+            if labels is None:
+                log(f"[warn] Batch of {len(items)} got a reply that doesn't match one label per file; retrying one at a time: "
+                    + ", ".join(str(entry.path) for entry, _, _ in items))
+        if labels is None:
+            for item in items:
+                await run_single(item)
+            return
+        for item, label in zip(items, labels):
+            await finish(item, label)
+
+    while True:
+        items = await work_q.get()
+        if items is None:
+            return
+        if len(items) == 1:
+            await run_single(items[0])
+        else:
+            await run_batch(items)
+
+
+async def next_done(done_q: asyncio.Queue, tasks: set):
+    """
+    Return the next entry from `done_q`, re-raising the exception of any pipeline
+    task in `tasks` that fails first (it would otherwise leave main() waiting for
+    entries that never come). Tasks that finish normally are removed from `tasks`.
+    """
+    getter = asyncio.ensure_future(done_q.get())
+    try:
+        while tasks:
+            finished, _ = await asyncio.wait({getter, *tasks}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in finished:
+                return getter.result()
+            for task in finished:
+                tasks.discard(task)
+                task.result()  # raises if the task failed or was cancelled
+        return await getter
+    finally:
+        getter.cancel()
+
+
+async def main():
     parser = argparse.ArgumentParser(description="Classify documents in a folder using an LLM.")
     parser.add_argument("root", type=Path, help="Root folder to scan")
     parser.add_argument("--dry-run", action="store_true", help="Scan & render only; do not call the LLM")
+    parser.add_argument("--resume", action="store_true", help="Skip files already listed in an existing filelist.csv and append to it")
+    parser.add_argument("--no-cache", action="store_true", help=f"Do not read or write the label cache ({CACHE_DB})")
+    parser.add_argument("--batch", type=int, default=4, metavar="K", help="Classify up to K single-page files per LLM request (1 disables batching)")
     args = parser.parse_args()
 
     settings = AppSettings()  # pulls from env/.env
@@ -322,37 +863,94 @@ def main():
         raise SystemExit(f"Root folder not found: {root}")
 
     from tqdm import tqdm
-    files = list(iter_files(root))
-    results = []
-    for path in tqdm(files, desc="Classifying", unit="file"):
-        imgs = file_to_images(path)
-        if not imgs:
-            # Not a supported type—just note and continue
-            print(f"[skip] {path}")
-            continue
-
-        if args.dry_run:
-            print(f"[dry] {path} -> {len(imgs)} page(s)")
-            continue
-
-        try:
-            label = classify_images(settings.llm_name, settings.llm_api_key, prompt, imgs, settings.llm_model)
-            # keep output very simple / greppable
-            results.append({'path': path.resolve(), 'label': label, 'llm': settings.llm_name, 'model': settings.llm_model, 'filename': path.name})
-        except Exception as e:
-            print(f"[error] {path}: {e}")
-
-    # Write results to CSV
     output_csv = root / "filelist.csv"
-    with open(output_csv, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['filename', 'label', 'llm', 'model', 'path']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in results:
-            writer.writerow(row)
+    log_path = root / "classifier.log"
+    resume = args.resume and output_csv.exists()
+    done = read_done_paths(output_csv) if resume else set()
+    files = [
+        f for f in iter_files(root)
+        if f.path not in (output_csv, log_path) and not (done and str(f.path.resolve()) in done)
+    ]
+    if done:
+        print(f"[resume] {len(done)} file(s) already classified in {output_csv}")
+
+    classifier, close_classifier = None, _no_close
+    if not args.dry_run:
+        try:
+            classifier, close_classifier = make_classifier(settings.llm_name, settings.llm_api_key, settings.llm_model, prompt)
+        except ValueError as e:
+            raise SystemExit(str(e))
+
+    workers = os.cpu_count() or 1
+    llm_workers = max(1, settings.llm_concurrency)
+    cache = None
+    if not args.no_cache and not args.dry_run:
+        try:
+            cache = LabelCache(CACHE_DB, settings.llm_name, settings.llm_model, prompt)
+        except (OSError, sqlite3.Error) as e:
+            print(f"[warn] Label cache disabled: {e}")
+    log = RunLog(log_path, append=resume)
+    try:
+        # Stream rows to the CSV as they complete so an interrupted run keeps its work
+        with open(output_csv, 'a' if resume else 'w', newline='', encoding='utf-8', buffering=1 << 20) as csvfile, \
+                ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker) as pool:
+            writer = csv.writer(csvfile)
+            if not resume:
+                writer.writerow(CSV_FIELDS)
+
+            # Pipeline: `workers` renderers (process pool) feed a bounded queue; one
+            # batcher groups small files from it for the `llm_workers` LLM callers,
+            # so CPU and network stay busy together.
+            render_q: asyncio.Queue = asyncio.Queue(maxsize=2 * workers)
+            work_q: asyncio.Queue = asyncio.Queue(maxsize=llm_workers)
+            done_q: asyncio.Queue = asyncio.Queue()
+            files_iter = iter(files)
+            renderers = [
+                asyncio.create_task(render_worker(files_iter, render_q, done_q, pool, settings, cache, args.dry_run, log))
+                for _ in range(workers)
+            ]
+            batcher = asyncio.create_task(batch_worker(render_q, work_q, llm_workers, args.batch))
+            classifiers = [
+                asyncio.create_task(classify_worker(work_q, done_q, classifier, settings, cache, log))
+                for _ in range(llm_workers)
+            ]
+
+            async def stop_batcher():
+                await asyncio.gather(*renderers)
+                await render_q.put(None)
+
+            stopper = asyncio.create_task(stop_batcher())
+            tasks = {*renderers, stopper, batcher, *classifiers}
+
+            try:
+                written = 0
+                for _ in tqdm(range(len(files)), desc="Classifying", unit="file"):
+                    r = await next_done(done_q, tasks)
+                    if r is None:
+                        continue
+                    writer.writerow((r['filename'], r['label'], r['llm'], r['model'], str(r['path'])))
+                    written += 1
+                    if written % CSV_FLUSH_EVERY == 0:
+                        csvfile.flush()
+
+                await asyncio.gather(*tasks)
+            finally:
+                # If a task failed, don't leave the rest blocked on queues nobody serves
+                for task in tasks:
+                    task.cancel()
+    finally:
+        # Runs on Ctrl-C and errors too, so buffered status lines aren't lost
+        log.close()
+        if cache is not None:
+            try:
+                cache.close()
+            except sqlite3.Error as e:
+                print(f"[warn] Could not save the last labels to the cache: {e}")
+        await close_classifier()
 
     print(f"\nResults written to: {output_csv}")
+    print(f"Status log written to: {log_path}")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())